@@ -1,56 +1,69 @@
 import os
-import subprocess
 import json
 import logging
+import mmap
 import re
-from validation import validate_project, write_validation_report
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from llm import build_cmd, run_llama, clean_code_output, RunawayGuard, LineProgress
+from validation import validate_project, write_validation_report, validate_file, is_standalone_file, file_stamp
 from analyzer import analyze_validation_results
 from repair import repair_project
 from dependency_check import scan_missing_dependencies, log_dependency_fix_instructions
 
-# ----------------------------
-# Clean LLM Output
-# ----------------------------
-def clean_code_output(raw_output):
-    raw_output = re.sub(r'^.*assistant\s*', '', raw_output, flags=re.DOTALL)
-    raw_output = re.sub(r'>\s*EOF.*$', '', raw_output, flags=re.MULTILINE)
-    raw_output = re.sub(r"^```[a-zA-Z]*", "", raw_output.strip(), flags=re.MULTILINE)
-    raw_output = re.sub(r"```$", "", raw_output, flags=re.MULTILINE)
-    return raw_output.strip()
-
 # ----------------------------
 # Fix Includes for C++
 # ----------------------------
+_INCLUDE_RE = re.compile(r'#include\s+"([^"]+)"')
+_INCLUDE_RE_BYTES = re.compile(rb'#include\s+"([^"]+)"')
+
+def _has_quoted_include(file_path):
+    """
+    mmap-backed pre-check so large files without quoted includes are never
+    decoded into a str. Files under one page are cheaper to just read.
+    """
+    if os.path.getsize(file_path) < mmap.PAGESIZE:
+        return True
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _INCLUDE_RE_BYTES.search(mm) is not None
+
 def fix_cpp_includes(project_folder):
     logging.info(f"[FixIncludes] Scanning for header files...")
+    # Single walk: collect headers and the sources to rewrite in one pass
     header_map = {}
+    source_files = []
     for root, _, files in os.walk(project_folder):
         for file in files:
-            if file.endswith(".h"):
+            if file.endswith(".cpp") or file.endswith(".h"):
                 full_path = os.path.join(root, file)
-                rel_path = os.path.relpath(full_path, project_folder).replace("\\", "/")
-                header_map[file] = rel_path
+                source_files.append(full_path)
+                if file.endswith(".h"):
+                    rel_path = os.path.relpath(full_path, project_folder).replace("\\", "/")
+                    header_map[file] = rel_path
 
-    include_pattern = re.compile(r'#include\s+"([^"]+)"')
     fixes_applied = 0
-    for root, _, files in os.walk(project_folder):
-        for file in files:
-            if file.endswith(".cpp") or file.endswith(".h"):
-                file_path = os.path.join(root, file)
-                with open(file_path, "r") as f:
-                    content = f.read()
-                updated_content = content
-                for match in include_pattern.findall(content):
-                    if match in header_map:
-                        correct_path = header_map[match]
-                        updated_content = updated_content.replace(
-                            f'#include "{match}"', f'#include "{correct_path}"'
-                        )
-                if updated_content != content:
-                    with open(file_path, "w") as f:
-                        f.write(updated_content)
-                    logging.info(f"[FixIncludes] Updated includes in {file_path}")
-                    fixes_applied += 1
+    for file_path in source_files:
+        if not _has_quoted_include(file_path):
+            continue
+        with open(file_path, "r") as f:
+            content = f.read()
+
+        # Single pass: rewrite each include as it is matched instead of one str.replace per match
+        rewrites = 0
+        def _fix(m):
+            nonlocal rewrites
+            correct_path = header_map.get(m.group(1))
+            if not correct_path or correct_path == m.group(1):
+                return m.group(0)
+            rewrites += 1
+            return f'#include "{correct_path}"'
+
+        updated_content = _INCLUDE_RE.sub(_fix, content)
+        if rewrites:
+            with open(file_path, "w") as f:
+                f.write(updated_content)
+            logging.info(f"[FixIncludes] Updated includes in {file_path}")
+            fixes_applied += 1
     logging.info(f"[FixIncludes] Total include fixes applied: {fixes_applied}")
     return fixes_applied
 
@@ -132,6 +145,23 @@ LANGUAGE_HINTS = {
     "java": "Ensure proper Java syntax with main method and correct package structure."
 }
 
+# Output budget per file kind: only files that are reliably short get a lower ceiling;
+# everything else (compose files, HTML pages, seeded SQL, ...) keeps the full 4096
+SMALL_FILE_TOKENS = 256
+MEDIUM_FILE_TOKENS = 1024
+LARGE_FILE_TOKENS = 4096
+SMALL_FILE_NAMES = {"requirements.txt", "dockerfile", "cmakelists.txt"}
+MEDIUM_FILE_EXTENSIONS = (".h", ".hpp")
+
+def predict_tokens(path):
+    """Heuristic n_predict ceiling for a planned file, based on its name."""
+    name = os.path.basename(path).lower()
+    if name in SMALL_FILE_NAMES:
+        return SMALL_FILE_TOKENS
+    if name.endswith(MEDIUM_FILE_EXTENSIONS):
+        return MEDIUM_FILE_TOKENS
+    return LARGE_FILE_TOKENS
+
 # ----------------------------
 # Main Function
 # ----------------------------
@@ -159,19 +189,14 @@ def generate_files(job_id, PROJECTS_DIR, LLAMA_PATH, MODEL_CODE_PATH, update_job
     total_files = len(files)
     logging.info(f"[Job {job_id}] Detected language: {language.upper()}. Generating {total_files} files...")
 
-    # Generate Files
-    for idx, file_info in enumerate(files, start=1):
-        path = file_info.get("path")
-        abs_path = os.path.join(project_folder, path)
-        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-
-        context_prompt = f"""
-Generate a COMPLETE {language.upper()} file for: {path}
+    # ✅ Shared prompt header: serialized once, identical prefix for every file
+    plan_json = json.dumps(plan, indent=2)
+    prompt_header = f"""
 Project Description:
 {original_prompt}
 
 Full Plan:
-{json.dumps(plan, indent=2)}
+{plan_json}
 
 Language Guidelines:
 {language_hint}
@@ -180,19 +205,62 @@ Rules:
 - Output ONLY code (no markdown).
 - Ensure file compiles/runs successfully with all required imports.
 """
+
+    # ✅ KV prompt cache shared by all per-file calls (kept out of the project folder / ZIP)
+    prompt_cache = os.path.join(tempfile.gettempdir(), f"deepseek_job_{job_id}_prompt.kv")
+    prompt_cache_ready = False
+    # ✅ Small files first (stable within each bucket), each bucket with its own n_predict ceiling
+    ordered_files = sorted(files, key=lambda f: predict_tokens(f.get("path", "")))
+    cmds = {
+        n_predict: build_cmd(LLAMA_PATH, MODEL_CODE_PATH, ctx_size=8192, n_predict=n_predict,
+                             temp=0.25, top_p=0.9, repeat_penalty=1.05)
+        for n_predict in (SMALL_FILE_TOKENS, MEDIUM_FILE_TOKENS, LARGE_FILE_TOKENS)
+    }
+
+    # ✅ Validate standalone files in the background while the next file generates
+    validation_pool = ThreadPoolExecutor(max_workers=4)
+    pending_validations = {}
+
+    # Generate Files
+    for idx, file_info in enumerate(ordered_files, start=1):
+        path = file_info.get("path")
+        abs_path = os.path.join(project_folder, path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+
+        context_prompt = f"{prompt_header}\nGenerate a COMPLETE {language.upper()} file for: {path}\n"
         progress = int((idx / total_files) * 70)
         update_job_status(job_id, "processing", message=f"Generating {language.upper()} file {idx}/{total_files}: {path}", progress=progress, current_step=f"File {idx}/{total_files} - {path}")
 
-        cmd = [LLAMA_PATH, "-m", MODEL_CODE_PATH, "-t", "28", "--ctx-size", "8192", "--n-predict", "4096", "--temp", "0.25", "--top-p", "0.9", "--repeat-penalty", "1.05", "-p", context_prompt]
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=1500)
-            cleaned_output = clean_code_output(result.stdout.strip())
-            with open(abs_path, "w") as f:
-                f.write(cleaned_output or f"// ERROR: No content generated for {path}")
+            guard = RunawayGuard()
+            # ✅ Live line count in the UI while the file streams (writes coalesced by ProgressThrottle)
+            watch = LineProgress(guard, lambda lines: update_job_status(
+                job_id, "processing", progress=progress, current_step=f"File {idx}/{total_files} - {path} ({lines} lines)"))
+            raw_output = run_llama(cmds[predict_tokens(path)], context_prompt, timeout=1500, prompt_cache=prompt_cache, prompt_cache_ro=prompt_cache_ready, should_stop=watch)
+            prompt_cache_ready = os.path.exists(prompt_cache)
+            cleaned_output = clean_code_output(raw_output.strip())
+
+            # ✅ Decode loop cut short: retry once with a stronger repeat penalty
+            if guard.reason == "repetition":
+                logging.warning(f"[Job {job_id}] Repetition loop detected in {path}, retrying with higher repeat penalty")
+                retry_cmd = build_cmd(LLAMA_PATH, MODEL_CODE_PATH, ctx_size=8192, n_predict=predict_tokens(path),
+                                      temp=0.25, top_p=0.9, repeat_penalty=1.15)
+                retry_output = clean_code_output(run_llama(retry_cmd, context_prompt, timeout=1500, prompt_cache=prompt_cache, prompt_cache_ro=prompt_cache_ready, should_stop=RunawayGuard()).strip())
+                cleaned_output = retry_output or cleaned_output
+            # ✅ One encode + one binary write, no TextIOWrapper in between
+            with open(abs_path, "wb") as f:
+                f.write((cleaned_output or f"// ERROR: No content generated for {path}").encode("utf-8"))
             logging.info(f"[Job {job_id}] ✅ File saved: {path}")
+            if is_standalone_file(abs_path):
+                pending_validations[os.path.normpath(abs_path)] = (
+                    file_stamp(abs_path), validation_pool.submit(validate_file, abs_path, project_folder)
+                )
         except Exception as e:
             logging.error(f"[Job {job_id}] ❌ Error generating {path}: {e}")
 
+    if os.path.exists(prompt_cache):
+        os.remove(prompt_cache)
+
     update_job_status(job_id, "processing", message="Applying auto-fixes...", progress=80)
     if language == "cpp":
         fix_cpp_includes(project_folder)
@@ -205,7 +273,14 @@ Rules:
 
     # Validation & Repair
     update_job_status(job_id, "processing", message="Validating project...", progress=85)
-    validation_results = validate_project(project_folder)
+    prevalidated = {}
+    for file_path, (stamp, future) in pending_validations.items():
+        try:
+            prevalidated[file_path] = (stamp, future.result())
+        except Exception as e:
+            logging.warning(f"[Job {job_id}] Early validation failed for {file_path}: {e}")
+    validation_pool.shutdown()
+    validation_results = validate_project(project_folder, prevalidated)
     report_path = write_validation_report(project_folder, job_id, validation_results)
     failed_files = analyze_validation_results(validation_results)
 
@@ -213,5 +288,5 @@ Rules:
         update_job_status(job_id, "processing", message="Repairing files...", progress=90)
         repair_project(job_id, project_folder, failed_files, original_prompt, plan, LLAMA_PATH, MODEL_CODE_PATH, validate_project, analyze_validation_results, write_validation_report, update_job_status)
 
-    update_job_status(job_id, "completed", f"Project complete. Report: {report_path}", 100, "Completed")
-    return True
+    # Caller marks the job completed once the ZIP exists (one terminal write per job)
+    return report_path
@@ -1,69 +1,401 @@
+import contextlib
+import os
+import queue
 import sqlite3
+import threading
+import time
 from datetime import datetime
 
 DB_PATH = "jobs.db"
+BUSY_TIMEOUT_MS = 30000
+JOBS_PAGE_SIZE = 200
+MAX_JOB_ID = 2 ** 63 - 1  # "no cursor" sentinel for get_all_jobs
+CROSS_PROCESS_POLL = 1.0  # seconds between data_version checks while the worker is idle
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+STATEMENT_CACHE_SIZE = 256
+MAX_JOB_ATTEMPTS = 3  # claims per job before an interrupted job is failed instead of requeued
+MMAP_SIZE = 256 * 1024 * 1024
+READ_POOL_SIZE = min(4, os.cpu_count() or 1)  # idle read-only connections kept open
+
+# ----------------------------
+# SQL (module constants so every call reuses the same prepared statement)
+# ----------------------------
+# Millisecond timestamp bumped on every write, so pollers can tell whether anything changed
+SQL_NOW_MS = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+SQL_ADD_JOB = f"""
+INSERT INTO jobs (prompt, type, status, created_at, created_at_epoch, updated_at)
+VALUES (?, ?, 'queued', ?, ?, {SQL_NOW_MS})
+"""
+SQL_UPDATE_PROGRESS = f"""
+UPDATE jobs SET status=?, progress=?, current_step=?, completed_at=NULL, completed_at_epoch=NULL, updated_at={SQL_NOW_MS}
+WHERE id=?
+"""
+SQL_UPDATE_COMPLETED = f"""
+UPDATE jobs SET status=?, completed_at=CURRENT_TIMESTAMP, completed_at_epoch=CAST(strftime('%s', 'now') AS INTEGER),
+progress=?, current_step=?, updated_at={SQL_NOW_MS}
+WHERE id=?
+"""
+SQL_SAVE_OUTPUT = "INSERT OR REPLACE INTO job_outputs (job_id, output) VALUES (?, ?)"
+SQL_CLAIM_NEXT = f"""
+UPDATE jobs SET status='processing', attempts=attempts + 1, updated_at={SQL_NOW_MS}
+WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id ASC LIMIT 1)
+RETURNING id, prompt, type
+"""
+SQL_INTERRUPTED_EXHAUSTED = "SELECT id FROM jobs WHERE status IN ('processing', 'planned') AND attempts >= ?"
+SQL_REQUEUE_INTERRUPTED = f"""
+UPDATE jobs SET status='queued', progress=NULL, current_step=NULL, updated_at={SQL_NOW_MS}
+WHERE status IN ('processing', 'planned')
+"""
+SQL_QUEUE_HEAD = "SELECT id, prompt, type FROM jobs WHERE status = 'queued' ORDER BY id ASC LIMIT 1"
+SQL_MARK_PROCESSING = f"UPDATE jobs SET status='processing', attempts=attempts + 1, updated_at={SQL_NOW_MS} WHERE id=?"
+# Timestamps come back as epoch ints; the TEXT columns only cover rows the backfill could not parse
+SQL_LIST_JOBS = """
+SELECT id, prompt, type, status,
+       COALESCE(created_at_epoch, created_at) AS created_at,
+       COALESCE(completed_at_epoch, completed_at) AS completed_at
+FROM jobs WHERE id < ? ORDER BY id DESC LIMIT ?
+"""
+SQL_JOB_META = """
+SELECT id, prompt, type, status,
+       COALESCE(created_at_epoch, created_at) AS created_at,
+       COALESCE(completed_at_epoch, completed_at) AS completed_at,
+       progress, current_step
+FROM jobs WHERE id=?
+"""
+SQL_JOB_OUTPUT = "SELECT output FROM job_outputs WHERE job_id=?"
+# Two scalar subqueries: each max() gets SQLite's min/max shortcut (one index SEARCH);
+# a single SELECT with two aggregates would scan the whole index instead
+SQL_JOBS_VERSION = "SELECT (SELECT max(id) FROM jobs), (SELECT max(updated_at) FROM jobs)"
+
+# ✅ One long-lived write connection shared by the worker and HTTP handlers (autocommit, guarded by _lock)
+_conn = None
+_lock = threading.Lock()
+
+# ✅ Page/detail reads use their own connections: under WAL they never wait on the writer or its lock
+_read_pool = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+_read_generation = 0  # bumped by reset_connection so stale readers are closed, not pooled
+
+# ✅ Signalled by add_job so the worker wakes immediately instead of polling
+job_event = threading.Condition()
+_jobs_added = 0
+
+def connect():
+    """Open a connection with the per-connection PRAGMAs applied."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row  # rows unpack like tuples and also read by column name
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")  # wait on the worker/HTTP lock instead of raising
+    conn.execute("PRAGMA synchronous=NORMAL")  # safe under WAL, no fsync per commit
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")  # ~64 MB page cache
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")  # reads come straight from the OS page cache
+    return conn
+
+def _shared_conn():
+    """Return the shared connection, opening it on first use. Call with _lock held."""
+    global _conn
+    if _conn is None:
+        _conn = connect()
+    return _conn
+
+@contextlib.contextmanager
+def _reader():
+    """Borrow a pooled read connection (opened on demand) for one query."""
+    generation = _read_generation
+    try:
+        conn = _read_pool.get_nowait()
+    except queue.Empty:
+        conn = connect()
+        conn.execute("PRAGMA query_only=ON")
+    try:
+        yield conn
+    finally:
+        if generation != _read_generation:
+            _close_quietly(conn)
+        else:
+            try:
+                _read_pool.put_nowait(conn)
+            except queue.Full:
+                _close_quietly(conn)
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+def reset_connection():
+    """Drop the shared and pooled connections after an OperationalError; the next call reopens them."""
+    global _conn, _read_generation
+    with _lock:
+        if _conn is not None:
+            _close_quietly(_conn)
+            _conn = None
+        _read_generation += 1
+    while True:
+        try:
+            _close_quietly(_read_pool.get_nowait())
+        except queue.Empty:
+            break
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS jobs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        prompt TEXT,
-        type TEXT,
-        status TEXT,
-        output TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        completed_at TEXT,
-        progress INTEGER DEFAULT 0,
-        current_step TEXT
-    )
-    """)
-    conn.commit()
-    conn.close()
+    with _lock:
+        conn = _shared_conn()
+        # ✅ WAL is persistent on the DB file: readers no longer block on the worker's writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prompt TEXT,
+            type TEXT,
+            status TEXT,
+            output TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            completed_at TEXT,
+            progress INTEGER DEFAULT 0,
+            current_step TEXT
+        )
+        """)
+        # Queue head lookup (status='queued' ORDER BY id) reads the first entry of a partial
+        # index holding only queued rows; status changes of finished jobs never touch it
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs(id) WHERE status = 'queued'")
+        conn.execute("DROP INDEX IF EXISTS idx_jobs_status_id")
+        # ✅ Check-and-ALTER under one write lock: with uvicorn --workers N every process runs this
+        # at once, and without it the losers crash with "duplicate column name"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Added after the first release: last-write stamp used for the job table ETag
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "updated_at" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN updated_at TEXT")
+            # Epoch copies of the timestamps, so rendering needs no date string parsing
+            for column in ("created_at_epoch", "completed_at_epoch"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} INTEGER")
+            # Claim counter, so a job that keeps killing the worker is eventually failed
+            if "attempts" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            conn.execute("""
+            UPDATE jobs SET created_at_epoch = CAST(strftime('%s', created_at) AS INTEGER)
+            WHERE created_at_epoch IS NULL AND created_at IS NOT NULL
+            """)
+            conn.execute("""
+            UPDATE jobs SET completed_at_epoch = CAST(strftime('%s', completed_at) AS INTEGER)
+            WHERE completed_at_epoch IS NULL AND completed_at IS NOT NULL
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs(updated_at)")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        # ✅ Output lives in its own table so progress updates only rewrite the narrow jobs row
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_outputs (
+            job_id INTEGER PRIMARY KEY,
+            output TEXT
+        )
+        """)
+        # Move outputs written before the split; jobs.output is left NULL from here on
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+            INSERT OR IGNORE INTO job_outputs (job_id, output)
+            SELECT id, output FROM jobs WHERE output IS NOT NULL
+            """)
+            conn.execute("UPDATE jobs SET output=NULL WHERE output IS NOT NULL")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
 
 def add_job(prompt, job_type):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    created_at = datetime.utcnow().isoformat()
-    c.execute("""
-        INSERT INTO jobs (prompt, type, status, created_at)
-        VALUES (?, ?, 'queued', ?)
-    """, (prompt, job_type, created_at))
-    job_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    now = time.time()
+    created_at = datetime.utcfromtimestamp(now).isoformat()
+    with _lock:
+        c = _shared_conn().execute(SQL_ADD_JOB, (prompt, job_type, created_at, int(now)))
+        job_id = c.lastrowid
+    _notify_job_added()
     return job_id
 
+def _notify_job_added():
+    global _jobs_added
+    with job_event:
+        _jobs_added += 1
+        job_event.notify()
+
+def _data_version():
+    """Changes whenever another connection (e.g. the web process) commits to the DB."""
+    with _lock:
+        return _shared_conn().execute("PRAGMA data_version").fetchone()[0]
+
+def wait_for_job(timeout=30):
+    """
+    Block until add_job signals a new job, or another process commits (checked
+    every CROSS_PROCESS_POLL seconds via PRAGMA data_version, which reads no
+    table pages). Returns True when woken by either, False on timeout.
+    """
+    global _jobs_added
+    deadline = time.monotonic() + timeout
+    version = _data_version()
+    with job_event:
+        while not _jobs_added:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if job_event.wait_for(lambda: _jobs_added, min(remaining, CROSS_PROCESS_POLL)):
+                break
+            if _data_version() != version:
+                return True
+        _jobs_added = 0
+        return True
+
 def update_job_status(job_id, status, message=None, progress=None, current_step=None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    if status == "completed":
-        c.execute("""
-        UPDATE jobs SET status=?, output=?, completed_at=CURRENT_TIMESTAMP, progress=?, current_step=? WHERE id=?
-        """, (status, message, 100, None, job_id))
-    else:
-        c.execute("""
-        UPDATE jobs SET status=?, output=?, progress=?, current_step=?, completed_at=NULL WHERE id=?
-        """, (status, message, progress, current_step, job_id))
-    conn.commit()
-    conn.close()
-
-def get_all_jobs():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, prompt, type, status, created_at, completed_at FROM jobs ORDER BY id DESC")
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
-def get_job(job_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-    SELECT id, prompt, type, status, output, created_at, completed_at, progress, current_step
-    FROM jobs WHERE id=?
-    """, (job_id,))
-    job = c.fetchone()
-    conn.close()
-    return job
+    """
+    'processing' updates only touch the narrow jobs row; the message of any
+    other status (completed, error, planned) is stored in job_outputs.
+    """
+    with _lock:
+        conn = _shared_conn()
+        if status == "processing":
+            conn.execute(SQL_UPDATE_PROGRESS, (status, progress, current_step, job_id))
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if status == "completed":
+                conn.execute(SQL_UPDATE_COMPLETED, (status, 100, None, job_id))
+            else:
+                conn.execute(SQL_UPDATE_PROGRESS, (status, progress, current_step, job_id))
+            conn.execute(SQL_SAVE_OUTPUT, (job_id, message))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+def claim_next_job():
+    """
+    Atomically move the oldest queued job to 'processing' and return (id, prompt, type),
+    or None when the queue is empty. One statement on SQLite >= 3.35 (UPDATE ... RETURNING).
+    """
+    with _lock:
+        conn = _shared_conn()
+        if HAS_RETURNING:
+            # fetchall() runs the statement to completion so the autocommit write is released
+            rows = conn.execute(SQL_CLAIM_NEXT).fetchall()
+            return rows[0] if rows else None
+
+        # Older SQLite: SELECT + UPDATE inside one write transaction
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job = conn.execute(SQL_QUEUE_HEAD).fetchone()
+            if job:
+                conn.execute(SQL_MARK_PROCESSING, (job[0],))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job
+
+def requeue_interrupted_jobs(max_attempts=MAX_JOB_ATTEMPTS):
+    """
+    Put jobs left 'processing'/'planned' by a worker that died mid-run back in
+    the queue; jobs already claimed max_attempts times are marked 'error'
+    instead, so one poison job can't crash-loop the worker forever.
+    Call once at worker startup, before claiming; returns (requeued, failed).
+    """
+    with _lock:
+        conn = _shared_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            exhausted = [row[0] for row in conn.execute(SQL_INTERRUPTED_EXHAUSTED, (max_attempts,))]
+            for job_id in exhausted:
+                conn.execute(SQL_UPDATE_PROGRESS, ("error", None, None, job_id))
+                conn.execute(SQL_SAVE_OUTPUT, (job_id, f"Job interrupted {max_attempts} times; giving up."))
+            requeued = conn.execute(SQL_REQUEUE_INTERRUPTED).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    if requeued:
+        _notify_job_added()
+    return requeued, len(exhausted)
+
+def get_all_jobs(limit=JOBS_PAGE_SIZE, before_id=None):
+    """
+    Newest jobs first, one page at a time (output is never selected here).
+    Keyset pagination: pass the last id of the previous page as before_id, so
+    each page is a primary-key range read however deep it is.
+    """
+    if before_id is None:
+        before_id = MAX_JOB_ID
+    with _reader() as conn:
+        return conn.execute(SQL_LIST_JOBS, (before_id, limit)).fetchall()
+
+def get_job_meta(job_id):
+    """Everything the job detail view needs except the (possibly large) output."""
+    with _reader() as conn:
+        return conn.execute(SQL_JOB_META, (job_id,)).fetchone()
+
+def get_jobs_version():
+    """(max id, last write stamp) of the jobs table; changes whenever any job is added or updated."""
+    with _reader() as conn:
+        return tuple(conn.execute(SQL_JOBS_VERSION).fetchone())
+
+def get_job_output(job_id):
+    with _reader() as conn:
+        row = conn.execute(SQL_JOB_OUTPUT, (job_id,)).fetchone()
+    return row[0] if row else None
+
+class ProgressThrottle:
+    """
+    Wraps update_job_status for hot loops.
+    'processing' updates are coalesced and written at most once per interval
+    (the latest one is flushed by a timer so it is never lost); any other
+    status is written immediately and supersedes the pending update.
+    """
+    def __init__(self, update_fn=update_job_status, interval=0.5):
+        self.update_fn = update_fn
+        self.interval = interval
+        self._pending = None
+        self._last_flush = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __call__(self, job_id, status, message=None, progress=None, current_step=None):
+        with self._lock:
+            if status != "processing":
+                self._pending = None
+                self._cancel_timer()
+                self.update_fn(job_id, status, message, progress, current_step)
+                self._last_flush = time.monotonic()
+                return
+            self._pending = (job_id, status, message, progress, current_step)
+            elapsed = time.monotonic() - self._last_flush
+            if elapsed >= self.interval:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.interval - elapsed, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def cancel(self):
+        """Drop any pending update, so nothing lands after a terminal status written elsewhere."""
+        with self._lock:
+            self._pending = None
+            self._cancel_timer()
+
+    def _flush_locked(self):
+        self._cancel_timer()
+        if self._pending:
+            self.update_fn(*self._pending)
+            self._pending = None
+            self._last_flush = time.monotonic()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
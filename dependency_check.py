@@ -1,5 +1,7 @@
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 # Critical external dependencies for C++ projects
 CRITICAL_HEADERS = {
@@ -16,6 +18,38 @@ LANG_DEPENDENCIES = {
     "java": ["openjdk-17-jdk", "maven"]
 }
 
+# #include directives live at the top of a translation unit; only this prefix is read
+INCLUDE_SCAN_BYTES = 4096
+# One alternation over every critical header: a single pass matches only the includes we care about
+_HDR_RE = re.compile(
+    rb'#include\s*[<"](' + b"|".join(re.escape(h.encode()) for h in CRITICAL_HEADERS) + rb')[>"]'
+)
+# Regex hits map straight back to the CRITICAL_HEADERS key (no decode, one shared str per header)
+_HEADER_BY_BYTES = {h.encode(): h for h in CRITICAL_HEADERS}
+
+def _scan_includes(file_path):
+    """Return the CRITICAL_HEADERS included by a C++ file (bounded binary read, one regex pass)."""
+    with open(file_path, "rb") as f:
+        data = f.read(INCLUDE_SCAN_BYTES)
+    return {_HEADER_BY_BYTES[m.group(1)] for m in _HDR_RE.finditer(data)}
+
+# Header scan fan-out: file reads release the GIL, so threads overlap the I/O
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+SCAN_CHUNK_SIZE = 256
+
+# Directories never worth scanning for dependencies
+SKIP_DIRS = {".git", "node_modules", "build", "__pycache__"}
+
+def _walk_files(path):
+    """os.scandir-based walk: file type comes from the DirEntry, no extra stat per entry."""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in SKIP_DIRS:
+                    yield from _walk_files(entry.path)
+            elif entry.is_file():
+                yield entry
+
 def scan_missing_dependencies(project_folder):
     """
     Scan project for:
@@ -25,7 +59,7 @@ def scan_missing_dependencies(project_folder):
     Returns dict: {"missing": {...}, "install_command": "...", "notes": [...]}
     """
     logging.info("[DependencyCheck] Scanning for dependencies...")
-    found_headers = {hdr: False for hdr in CRITICAL_HEADERS}
+    found_headers = set()
     detected_langs = set()
     notes = []
 
@@ -33,35 +67,56 @@ def scan_missing_dependencies(project_folder):
     has_go_mod = False
     has_pom = False
 
-    for root, _, files in os.walk(project_folder):
-        for file in files:
-            file_path = os.path.join(root, file)
-            # Check for C++ headers
-            if file.endswith(".cpp") or file.endswith(".h"):
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    for header in CRITICAL_HEADERS:
-                        if header in content:
-                            found_headers[header] = True
-
-            # Detect language files
-            elif file.endswith(".py"):
-                detected_langs.add("python")
-            elif file.endswith(".go"):
-                detected_langs.add("go")
-            elif file.endswith(".java"):
-                detected_langs.add("java")
-
-            # Dependency files
-            if file == "requirements.txt":
-                has_pip = True
-            if file == "go.mod":
-                has_go_mod = True
-            if file == "pom.xml":
-                has_pom = True
+    headers_remaining = len(CRITICAL_HEADERS)
+    cpp_batch = []
+    pool = None
+
+    def scan_batch():
+        # Fan the batch out over the pool; merge on this thread so found_headers needs no lock
+        nonlocal pool, headers_remaining
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+        for headers in pool.map(_scan_includes, cpp_batch):
+            found_headers.update(headers)
+        headers_remaining = len(CRITICAL_HEADERS) - len(found_headers)
+        cpp_batch.clear()
+
+    for entry in _walk_files(project_folder):
+        file = entry.name
+        # Check for C++ headers
+        if file.endswith(".cpp") or file.endswith(".h"):
+            if headers_remaining:
+                cpp_batch.append(entry.path)
+                if len(cpp_batch) >= SCAN_CHUNK_SIZE:
+                    scan_batch()
+
+        # Detect language files
+        elif file.endswith(".py"):
+            detected_langs.add("python")
+        elif file.endswith(".go"):
+            detected_langs.add("go")
+        elif file.endswith(".java"):
+            detected_langs.add("java")
+
+        # Dependency files
+        if file == "requirements.txt":
+            has_pip = True
+        if file == "go.mod":
+            has_go_mod = True
+        if file == "pom.xml":
+            has_pom = True
+
+        # ✅ Nothing left to discover: stop walking the rest of the tree
+        if not headers_remaining and len(detected_langs) == len(LANG_DEPENDENCIES) and has_pip and has_go_mod and has_pom:
+            break
+
+    if cpp_batch and headers_remaining:
+        scan_batch()
+    if pool is not None:
+        pool.shutdown()
 
     # Build missing system dependencies
-    missing = {hdr: pkg for hdr, pkg in CRITICAL_HEADERS.items() if found_headers[hdr]}
+    missing = {hdr: pkg for hdr, pkg in CRITICAL_HEADERS.items() if hdr in found_headers}
     for lang in detected_langs:
         for pkg in LANG_DEPENDENCIES.get(lang, []):
             missing[f"{lang}-runtime"] = pkg
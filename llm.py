@@ -0,0 +1,463 @@
+import atexit
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# ✅ KV-cache quantization + flash attention, opt-in with LLAMA_KV_QUANT=1: needs a llama.cpp
+# build whose --flash-attn takes a value (on/off/auto); older builds reject "on" and generate nothing
+KV_QUANT_ENABLED = os.environ.get("LLAMA_KV_QUANT", "0") == "1"
+KV_CACHE_TYPE = os.environ.get("LLAMA_CACHE_TYPE", "q8_0")
+
+# Optional --batch-size / --ubatch-size overrides; unset keeps llama.cpp's own defaults
+LLAMA_BATCH_SIZE = os.environ.get("LLAMA_BATCH_SIZE", "")
+LLAMA_UBATCH_SIZE = os.environ.get("LLAMA_UBATCH_SIZE", "")
+
+def perf_args():
+    """Extra llama.cpp flags: batch overrides and a cheaper KV cache per decoded token."""
+    args = []
+    if LLAMA_BATCH_SIZE:
+        args += ["--batch-size", LLAMA_BATCH_SIZE]
+    if LLAMA_UBATCH_SIZE:
+        args += ["--ubatch-size", LLAMA_UBATCH_SIZE]
+    if not KV_QUANT_ENABLED:
+        return args
+    # Quantized V cache requires flash attention in llama.cpp
+    return args + ["--cache-type-k", KV_CACHE_TYPE, "--cache-type-v", KV_CACHE_TYPE, "--flash-attn", "on"]
+
+# ----------------------------
+# llama.cpp Invocation
+# ----------------------------
+def build_cmd(llama_path, model_path, ctx_size, n_predict, temp, top_p, repeat_penalty, threads=28):
+    """
+    Builds the llama-cli argv prefix once per call site.
+    Only the prompt file is appended per invocation by run_llama.
+    """
+    return [
+        llama_path, "-m", model_path,
+        "-t", str(threads),
+        "--ctx-size", str(ctx_size),
+        "--n-predict", str(n_predict),
+        "--temp", str(temp),
+        "--top-p", str(top_p),
+        "--repeat-penalty", str(repeat_penalty),
+    ] + perf_args()
+
+class RunawayGuard:
+    """
+    Early-stop check for streamed llama-cli output.
+    Trips on the '> EOF' marker (generation finished, llama-cli is waiting for input)
+    or when the same non-trivial line repeats back to back (decode loop).
+    """
+    def __init__(self, max_repeats=12, min_line_length=8):
+        self.max_repeats = max_repeats
+        self.min_line_length = min_line_length
+        self.reason = None
+        self._last_line = None
+        self._repeats = 0
+
+    def __call__(self, line):
+        if _EOF_MARKER_RE.search(line):
+            self.reason = "eof"
+            return True
+        stripped = line.strip()
+        if len(stripped) < self.min_line_length:
+            return False
+        if stripped == self._last_line:
+            self._repeats += 1
+            if self._repeats >= self.max_repeats:
+                self.reason = "repetition"
+                return True
+        else:
+            self._last_line = stripped
+            self._repeats = 1
+        return False
+
+_JSON_TOKEN_RE = re.compile(r'[{}"\\]')
+
+class JsonObjectGuard:
+    """
+    Early-stop check for JSON answers: trips as soon as one complete top-level
+    {...} object has streamed out (brace depth back to 0, braces inside strings
+    ignored), so the model's trailing commentary is never generated.
+    The closed text must parse as JSON and pass `accept` (default: any dict);
+    anything else, like prose "{the plan}", is skipped and streaming goes on.
+    Objects that appear verbatim in `ignore` (the prompt, which llama-cli echoes)
+    do not count. `inner` (e.g. a RunawayGuard) is checked first.
+    """
+    def __init__(self, ignore="", inner=None, accept=None):
+        self.ignore = ignore
+        self.inner = inner
+        self.accept = accept or (lambda obj: isinstance(obj, dict))
+        self.reason = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._object = []
+
+    def __call__(self, line):
+        if self.inner is not None and self.inner(line):
+            self.reason = self.inner.reason
+            return True
+        # ✅ Jump between the only characters that matter ({ } " \) in C instead of a per-char Python loop
+        start = 0 if self._depth else None
+        skip = -1  # index of a character escaped by the preceding backslash
+        if self._escaped:
+            skip, self._escaped = 0, False
+        for m in _JSON_TOKEN_RE.finditer(line):
+            i = m.start()
+            if i == skip:
+                continue
+            ch = m.group()
+            if self._depth == 0:
+                if ch != "{":
+                    continue
+                self._object = []
+                start = i
+            if self._in_string:
+                if ch == "\\":
+                    skip = i + 1
+                    self._escaped = skip == len(line)  # escape continues on the next line
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._object.append(line[start:i + 1])
+                    if self._complete("".join(self._object)):
+                        self.reason = "json"
+                        return True
+        if self._depth:
+            self._object.append(line[start:])
+        return False
+
+    def _complete(self, text):
+        if text in self.ignore:
+            return False
+        try:
+            return self.accept(json.loads(text))
+        except ValueError:
+            return False
+
+class LineProgress:
+    """
+    Wraps a should_stop check (e.g. a RunawayGuard) and calls report(lines)
+    every `every` streamed lines, so long generations can surface progress.
+    """
+    def __init__(self, should_stop, report, every=20):
+        self.should_stop = should_stop
+        self.report = report
+        self.every = every
+        self.lines = 0
+
+    def __call__(self, line):
+        self.lines += 1
+        if self.lines % self.every == 0:
+            self.report(self.lines)
+        return self.should_stop(line)
+
+def _stream_output(args, timeout, should_stop):
+    """Reads llama-cli stdout line by line and kills the process as soon as should_stop trips."""
+    proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True)
+    timed_out = threading.Event()
+
+    def _on_timeout():
+        timed_out.set()
+        proc.kill()
+
+    watchdog = threading.Timer(timeout, _on_timeout)
+    watchdog.start()
+    lines = []
+    stopped = False
+    try:
+        for line in proc.stdout:
+            lines.append(line)
+            if should_stop(line):
+                stopped = True
+                break
+    finally:
+        watchdog.cancel()
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(args, timeout)
+    # A process we killed on purpose counts as a clean exit
+    return "".join(lines), 0 if stopped else proc.returncode
+
+# ----------------------------
+# llama-server (model stays loaded between requests)
+# ----------------------------
+# ✅ LLAMA_SERVER=0 rolls back to one llama-cli process per request
+LLAMA_SERVER_ENABLED = os.environ.get("LLAMA_SERVER", "1") != "0"
+LLAMA_SERVER_HOST = "127.0.0.1"
+LLAMA_SERVER_PORT = int(os.environ.get("LLAMA_SERVER_PORT", "8080"))
+LLAMA_SERVER_START_TIMEOUT = 300  # seconds to wait for the model to load
+# ✅ Sequences decoded together via continuous batching; follows the concurrency gate by default
+LLAMA_SERVER_PARALLEL = max(1, int(os.environ.get("LLAMA_SERVER_PARALLEL",
+                                                  os.environ.get("LLAMA_MAX_CONCURRENT", "1"))))
+# With one slot every request reuses its KV cache; with several, -1 lets the server pick
+# the idle slot whose cached prompt shares the longest prefix
+LLAMA_SERVER_SLOT = 0 if LLAMA_SERVER_PARALLEL == 1 else -1
+
+# Sampling flags in a build_cmd argv -> llama-server request fields
+_SERVER_FIELDS = {
+    "--n-predict": ("n_predict", int),
+    "--temp": ("temperature", float),
+    "--top-p": ("top_p", float),
+    "--repeat-penalty": ("repeat_penalty", float),
+}
+
+_servers = {}  # model_path -> LlamaServer
+
+class LlamaServer:
+    """One llama-server process serving a single model over HTTP."""
+    def __init__(self, llama_path, model_path, port, ctx_size=8192, threads=28):
+        self.model_path = model_path
+        self.url = f"http://{LLAMA_SERVER_HOST}:{port}"
+        self.args = [
+            os.path.join(os.path.dirname(llama_path), "llama-server"), "-m", model_path,
+            "-t", str(threads),
+            # llama-server splits --ctx-size across slots, so each one still gets ctx_size
+            "--ctx-size", str(ctx_size * LLAMA_SERVER_PARALLEL),
+            "--parallel", str(LLAMA_SERVER_PARALLEL),
+            "--cont-batching",
+            "--host", LLAMA_SERVER_HOST,
+            "--port", str(port),
+        ] + perf_args()
+        self.proc = None
+
+    def start(self):
+        """Spawn the server and block until /health reports the model is loaded."""
+        try:
+            self.proc = subprocess.Popen(self.args, stdin=subprocess.DEVNULL,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            # e.g. no llama-server binary next to llama-cli; the caller falls back to llama-cli
+            logging.warning(f"[LLM] Could not launch {self.args[0]}: {e}")
+            return False
+        deadline = time.monotonic() + LLAMA_SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                return False
+            try:
+                with urllib.request.urlopen(f"{self.url}/health", timeout=5) as resp:
+                    if resp.status == 200:
+                        return True
+            except (urllib.error.URLError, OSError):
+                pass  # 503 while loading, connection refused before bind
+            time.sleep(1)
+        self.stop()
+        return False
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def complete(self, prompt, params, timeout, should_stop=None):
+        """
+        Streams a chat completion and returns the generated text.
+        should_stop sees each completed line; returning True closes the stream,
+        which makes the server abort the generation.
+        """
+        body = dict(params, messages=[{"role": "user", "content": prompt}],
+                    stream=True, cache_prompt=True, id_slot=LLAMA_SERVER_SLOT)
+        request = urllib.request.Request(f"{self.url}/v1/chat/completions",
+                                         data=json.dumps(body).encode(),
+                                         headers={"Content-Type": "application/json"})
+        deadline = time.monotonic() + timeout
+        chunks = []
+        pending = ""
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as resp:
+                for raw in resp:
+                    if time.monotonic() > deadline:
+                        raise subprocess.TimeoutExpired(self.args, timeout)
+                    line = raw.decode("utf-8", errors="replace").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                    if not delta:
+                        continue
+                    chunks.append(delta)
+                    if should_stop:
+                        pending += delta
+                        *done, pending = pending.split("\n")
+                        if any(should_stop(l + "\n") for l in done):
+                            break
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return "".join(chunks)
+
+def start_server(llama_path, model_path, ctx_size=8192, port=LLAMA_SERVER_PORT):
+    """
+    Starts a llama-server for model_path (once) and registers it, so run_llama
+    sends requests for that model over HTTP instead of spawning llama-cli.
+    Returns False when disabled or the server fails to come up.
+    """
+    if not LLAMA_SERVER_ENABLED:
+        return False
+    server = _servers.get(model_path)
+    if server and server.alive():
+        return True
+    server = LlamaServer(llama_path, model_path, port, ctx_size)
+    logging.info(f"[LLM] Starting llama-server for {model_path} on port {port}")
+    if not server.start():
+        logging.warning(f"[LLM] llama-server failed to start, using llama-cli for {model_path}")
+        return False
+    _servers[model_path] = server
+    logging.info(f"[LLM] llama-server ready at {server.url}")
+    return True
+
+def stop_servers():
+    for server in _servers.values():
+        server.stop()
+    _servers.clear()
+
+atexit.register(stop_servers)
+
+def _server_params(cmd):
+    """Sampling parameters from a build_cmd argv, as llama-server request fields."""
+    params = {}
+    for flag, (field, convert) in _SERVER_FIELDS.items():
+        if flag in cmd:
+            params[field] = convert(cmd[cmd.index(flag) + 1])
+    return params
+
+# ----------------------------
+# Concurrency gate
+# ----------------------------
+# ✅ Max generations running at once across ALL worker processes on this host; each one needs
+# its own KV cache and competes for the same memory bandwidth, so overlapping runs only thrash
+LLAMA_MAX_CONCURRENT = max(1, int(os.environ.get("LLAMA_MAX_CONCURRENT", "1")))
+_SLOT_LOCK_PATHS = [
+    os.path.join(tempfile.gettempdir(), f"deepseek_llama_slot_{i}.lock") for i in range(LLAMA_MAX_CONCURRENT)
+]
+
+@contextlib.contextmanager
+def _inference_slot():
+    """Holds one of LLAMA_MAX_CONCURRENT flock()ed slot files; the kernel frees it if the process dies."""
+    while True:
+        for path in _SLOT_LOCK_PATHS:
+            f = open(path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+        time.sleep(0.5)
+
+def run_llama(cmd, prompt, timeout, prompt_cache=None, prompt_cache_ro=False, should_stop=None):
+    """
+    Sends the prompt to a running llama-server for the cmd's model when one
+    was started with start_server (its KV cache is reused across requests that
+    share a prompt prefix); otherwise falls back to llama-cli.
+    llama-cli gets the prompt through a file (-f) instead of argv, which keeps
+    multi-KB prompts off the command line and lets llama.cpp reuse a
+    saved KV prompt cache when prompt_cache is given.
+    With should_stop (e.g. a RunawayGuard), output is streamed and generation
+    is stopped once it returns True, instead of waiting for the full n_predict.
+    Returns the generated text only; llama-cli's prompt echo is stripped.
+    """
+    with _inference_slot():
+        try:
+            return _run_llama(cmd, prompt, timeout, prompt_cache, prompt_cache_ro, should_stop)
+        except PromptCacheError as e:
+            # ✅ A stale/incompatible/truncated session file must not fail every later job
+            logging.warning(f"[LLM] {e}; removing {prompt_cache} and retrying without it")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(prompt_cache)
+            return _run_llama(cmd, prompt, timeout, None, False, should_stop)
+
+class PromptCacheError(Exception):
+    """llama-cli produced nothing or failed while a --prompt-cache file was in use."""
+
+def _run_llama(cmd, prompt, timeout, prompt_cache, prompt_cache_ro, should_stop):
+    server = _servers.get(cmd[cmd.index("-m") + 1])
+    if server and server.alive():
+        try:
+            return server.complete(prompt, _server_params(cmd), timeout, should_stop)
+        except (urllib.error.URLError, ConnectionError) as e:
+            logging.warning(f"[LLM] llama-server request failed, falling back to llama-cli: {e}")
+
+    fd, prompt_path = tempfile.mkstemp(prefix="llama_prompt_", suffix=".txt")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(prompt)
+
+        args = cmd + ["-f", prompt_path]
+        if prompt_cache:
+            args += ["--prompt-cache", prompt_cache]
+            if prompt_cache_ro:
+                args.append("--prompt-cache-ro")
+
+        if should_stop:
+            output, returncode = _stream_output(args, timeout, should_stop)
+        else:
+            result = subprocess.run(args, capture_output=True, text=True, timeout=timeout)
+            output, returncode = result.stdout, result.returncode
+        if prompt_cache and (returncode != 0 or not output.strip()):
+            raise PromptCacheError(f"llama-cli exited {returncode} with {len(output)} chars of output")
+        return _strip_echo(output)
+    finally:
+        os.remove(prompt_path)
+
+def _strip_echo(raw_output):
+    """
+    Drops llama-cli's echoed prompt and role label (everything up to the last
+    'assistant'). Server completions carry neither, so they never pass through
+    here and generated code that says "assistant" stays intact.
+    """
+    # rfind is one C-level scan from the end; the old greedy '^.*assistant' regex ran to the end and backtracked
+    marker = raw_output.rfind(_ASSISTANT_MARKER)
+    if marker != -1:
+        raw_output = raw_output[marker + len(_ASSISTANT_MARKER):].lstrip()
+    return raw_output
+
+# ----------------------------
+# Clean LLM Output
+# ----------------------------
+_ASSISTANT_MARKER = "assistant"
+_EOF_MARKER_RE = re.compile(r'>\s*EOF.*$', flags=re.MULTILINE)
+_FENCE_OPEN_RE = re.compile(r"^```[a-zA-Z]*", flags=re.MULTILINE)
+_FENCE_CLOSE_RE = re.compile(r"```$", flags=re.MULTILINE)
+
+def clean_code_output(raw_output):
+    """
+    Cleans run_llama output (prompt echo already removed) by removing:
+    - 'EOF' markers
+    - Markdown fences like ```python ... ```
+    """
+    raw_output = _EOF_MARKER_RE.sub('', raw_output)
+    raw_output = _FENCE_OPEN_RE.sub("", raw_output.strip())
+    raw_output = _FENCE_CLOSE_RE.sub("", raw_output)
+    return raw_output.strip()
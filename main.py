@@ -1,19 +1,17 @@
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, Response
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 from threading import Thread
-from datetime import datetime
-import sqlite3
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+import asyncio
+import functools
+import hashlib
 import logging
-import pytz
 import os
-import time
-import shutil
-from dateutil import parser
-from db import add_job, init_db, get_all_jobs, get_job, update_job_status
-import planning
-import coding
-import quickmode  # ✅ Quick mode handler
+from db import add_job, init_db, get_all_jobs, get_job_meta, get_job_output, JOBS_PAGE_SIZE, get_jobs_version
+from worker import worker, PROJECTS_DIR
 
 # ----------------- Config -----------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -21,85 +19,49 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(me
 app = FastAPI(root_path="/chat")
 templates = Jinja2Templates(directory="templates")
 templates.env.globals["now"] = datetime.now
+# ✅ Compiled templates survive restarts; TEMPLATE_AUTO_RELOAD=1 re-enables the per-render stat() for editing
+# No directory argument: Jinja uses its per-user 0700 cache dir and checks ownership, so other
+# local users can't plant bytecode (a fixed shared /tmp path would let them)
+templates.env.bytecode_cache = FileSystemBytecodeCache()
+templates.env.auto_reload = os.environ.get("TEMPLATE_AUTO_RELOAD", "0") == "1"
 
-eastern = pytz.timezone("US/Eastern")
+eastern = ZoneInfo("America/New_York")
+LOCAL_TIME_FORMAT = "%b %d, %Y %I:%M %p %Z"
 
-# ✅ Centralized constants
-PROJECTS_DIR = "/home/smithkt/deepseek_projects"
-LLAMA_PATH = "/home/smithkt/llama.cpp/build/bin/llama-cli"
-MODEL_PLAN_PATH = "/home/smithkt/models/qwen/qwen2.5-coder-14b-instruct-q4_0.gguf"
-MODEL_CODE_PATH = "/home/smithkt/models/qwen/qwen2.5-coder-14b-instruct-q4_0.gguf"
+# Internal nginx location aliased to PROJECTS_DIR (e.g. /protected_projects/); empty = serve ZIPs from Python
+ZIP_ACCEL_REDIRECT_PREFIX = os.environ.get("ZIP_ACCEL_REDIRECT_PREFIX", "")
 
-os.makedirs(PROJECTS_DIR, exist_ok=True)
 init_db()
 
 # ----------------- Helpers -----------------
-def format_local_time(iso_str):
-    if not iso_str:
+# ✅ Memoized: every 30s table poll re-renders the same timestamps
+@functools.lru_cache(maxsize=4096)
+def format_local_time(value):
+    """Formats an epoch int (or a legacy UTC ISO string) in US/Eastern."""
+    if not value:
         return "—"
     try:
-        utc_time = parser.isoparse(iso_str)
-        local_time = utc_time.astimezone(eastern)
-        return local_time.strftime("%b %d, %Y %I:%M %p %Z")
+        if isinstance(value, int):
+            local_time = datetime.fromtimestamp(value, tz=eastern)
+        else:
+            utc_time = datetime.fromisoformat(value)
+            if utc_time.tzinfo is None:
+                utc_time = utc_time.replace(tzinfo=timezone.utc)  # stored timestamps are UTC
+            local_time = utc_time.astimezone(eastern)
+        return local_time.strftime(LOCAL_TIME_FORMAT)
     except Exception:
-        return iso_str
+        return value
 
 templates.env.filters["localtime"] = format_local_time
 
+# Compile every template at startup (after the filters exist) so no request pays for it
+for template_name in ("chat.html", "jobs.html", "partials/job_table.html", "partials/job_detail.html"):
+    templates.env.get_template(template_name)
+
 # ----------------- Worker -----------------
-def worker():
-    logging.info("Worker thread started")
-    while True:
-        try:
-            conn = sqlite3.connect("jobs.db")
-            c = conn.cursor()
-            c.execute("SELECT id, prompt, type FROM jobs WHERE status = 'queued' ORDER BY id ASC LIMIT 1")
-            job = c.fetchone()
-            conn.close()
-
-            if job:
-                job_id, prompt, job_type = job
-                logging.info(f"[Worker] Processing job {job_id} ({job_type})")
-
-                if job_type == "project":
-                    try:
-                        update_job_status(job_id, "processing", "Generating plan...")
-                        success = planning.generate_plan(
-                            job_id, prompt, PROJECTS_DIR, LLAMA_PATH, MODEL_PLAN_PATH, update_job_status
-                        )
-
-                        if success:
-                            update_job_status(job_id, "processing", "Generating and validating code...")
-                            report_path = coding.generate_files(
-                                job_id, PROJECTS_DIR, LLAMA_PATH, MODEL_CODE_PATH, update_job_status
-                            )
-
-                            # ✅ Create ZIP of the project
-                            project_folder = os.path.join(PROJECTS_DIR, f"job_{job_id}")
-                            zip_path = os.path.join(project_folder, f"job_{job_id}.zip")
-                            shutil.make_archive(zip_path.replace(".zip", ""), 'zip', project_folder)
-                            update_job_status(job_id, "completed", f"Project complete. Validation: {report_path}")
-                            logging.info(f"[Worker] Job {job_id} zipped at {zip_path}")
-                        else:
-                            update_job_status(job_id, "error", "Plan generation failed.")
-                    except Exception as e:
-                        logging.error(f"[Worker] Error in project workflow: {e}")
-                        update_job_status(job_id, "error", f"Workflow error: {e}")
-
-                elif job_type == "chat":
-                    try:
-                        quickmode.generate_quick_code(job_id, prompt, LLAMA_PATH, MODEL_CODE_PATH, update_job_status)
-                    except Exception as e:
-                        logging.error(f"[Worker] Error in quickmode: {e}")
-                        update_job_status(job_id, "error", f"QuickMode error: {e}")
-
-            else:
-                time.sleep(3)
-        except Exception as e:
-            logging.error(f"Worker loop error: {e}")
-            time.sleep(5)
-# Start the background worker
-Thread(target=worker, daemon=True).start()
+# ✅ EMBEDDED_WORKER=0 when worker.py runs as its own service (required with uvicorn --workers N)
+if os.environ.get("EMBEDDED_WORKER", "1") == "1":
+    Thread(target=worker, daemon=True).start()
 
 # ----------------- Routes -----------------
 @app.get("/", response_class=HTMLResponse)
@@ -109,38 +71,67 @@ async def get_chat(request: Request):
 @app.post("/", response_class=HTMLResponse)
 async def post_chat(request: Request, prompt: str = Form(...), generate_project: str = Form(None)):
     job_type = "project" if generate_project else "chat"
-    job_id = add_job(prompt, job_type)
+    # ✅ DB calls run in a worker thread so the event loop keeps serving while SQLite waits on its lock
+    job_id = await asyncio.to_thread(add_job, prompt, job_type)
     message = f"Your {job_type} job has been queued. Job ID: {job_id}"
-    return templates.TemplateResponse("chat.html", {"request": request, "prompt": "", "output": message})
+    # no-store: a submission receipt must never be replayed from a browser or proxy cache
+    return templates.TemplateResponse("chat.html", {"request": request, "prompt": "", "output": message},
+                                      headers={"Cache-Control": "no-store"})
 
 @app.get("/jobs", response_class=HTMLResponse)
-async def jobs_page(request: Request):
-    jobs = get_all_jobs()
-    return templates.TemplateResponse("jobs.html", {"request": request, "jobs": jobs})
+async def jobs_page(request: Request, before: int = None):
+    jobs = await asyncio.to_thread(get_all_jobs, before_id=before)
+    return templates.TemplateResponse("jobs.html", {
+        "request": request, "jobs": jobs, "before": before, "page_size": JOBS_PAGE_SIZE
+    })
 
 @app.get("/jobs/table", response_class=HTMLResponse)
-async def jobs_table_partial(request: Request):
-    jobs = get_all_jobs()
-    return templates.TemplateResponse("partials/job_table.html", {"request": request, "jobs": jobs})
+async def jobs_table_partial(request: Request, before: int = None):
+    # ✅ The table is polled every 30s: answer 304 unless a job was added or changed
+    max_id, last_update = await asyncio.to_thread(get_jobs_version)
+    etag = '"' + hashlib.blake2b(f"{before}:{max_id}:{last_update}".encode(), digest_size=8).hexdigest() + '"'
+    # no-cache: the browser revalidates every poll and reuses its copy on 304
+    cache_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+
+    jobs = await asyncio.to_thread(get_all_jobs, before_id=before)
+    return templates.TemplateResponse("partials/job_table.html", {
+        "request": request, "jobs": jobs, "before": before, "page_size": JOBS_PAGE_SIZE
+    }, headers=cache_headers)
 
 @app.get("/job/{job_id}", response_class=HTMLResponse)
 async def job_detail(request: Request, job_id: int):
-    job = get_job(job_id)
+    job = await asyncio.to_thread(get_job_meta, job_id)
     if not job:
         return HTMLResponse("<h1>Job not found</h1>", status_code=404)
 
-    # Correct index for job_type
-    job_type = job[2]  # Since our SELECT order is: id, prompt, type, status...
+    # ✅ Only finished jobs show their output, so only they load it
+    output = None
+    if job["status"] in ("completed", "error"):
+        output = await asyncio.to_thread(get_job_output, job_id)
     return templates.TemplateResponse("partials/job_detail.html", {
         "request": request,
         "job": job,
-        "job_type": job_type
+        "job_type": job["type"],
+        "output": output
     })
 
 @app.get("/job/{job_id}/download")
 async def download_zip(job_id: int):
     project_folder = os.path.join(PROJECTS_DIR, f"job_{job_id}")
     zip_path = os.path.join(project_folder, f"job_{job_id}.zip")
-    if os.path.exists(zip_path):
-        return FileResponse(zip_path, media_type="application/zip", filename=f"job_{job_id}.zip")
-    return HTMLResponse("<h1>ZIP file not found</h1>", status_code=404)
+    filename = f"job_{job_id}.zip"
+    try:
+        # One stat off the event loop: doubles as the existence check and gives Content-Length up front
+        stat_result = await asyncio.to_thread(os.stat, zip_path)
+    except FileNotFoundError:
+        return HTMLResponse("<h1>ZIP file not found</h1>", status_code=404)
+
+    # ✅ Behind nginx, hand the transfer off (sendfile) instead of streaming the bytes through Python
+    if ZIP_ACCEL_REDIRECT_PREFIX:
+        return Response(media_type="application/zip", headers={
+            "X-Accel-Redirect": f"{ZIP_ACCEL_REDIRECT_PREFIX.rstrip('/')}/job_{job_id}/{filename}",
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        })
+    return FileResponse(zip_path, media_type="application/zip", filename=filename, stat_result=stat_result)
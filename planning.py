@@ -1,55 +1,171 @@
 import os
+import re
 import json
+import hashlib
+import tempfile
 import subprocess
 import logging
-import re
+from llm import build_cmd, run_llama, clean_code_output, RunawayGuard, LineProgress, JsonObjectGuard
 
 # ------------------------------
 # Extract and Clean JSON Output
 # ------------------------------
+_JSON_DECODER = json.JSONDecoder()
+
 def extract_first_json(raw_output):
     """
-    Cleans LLM output and extracts the first valid JSON object.
+    Cleans LLM output and decodes the first complete plan object (a dict with a
+    "files" list). Prose before or after it (including stray braces) is ignored;
+    a nested file entry is never mistaken for the plan.
     """
-    # Remove assistant/user markers and EOF signals
-    cleaned = re.sub(r'^.*assistant\s*', '', raw_output, flags=re.DOTALL)
-    cleaned = re.sub(r'>\s*EOF.*$', '', cleaned, flags=re.MULTILINE)
-    cleaned = re.sub(r"^```[a-zA-Z]*", "", cleaned.strip(), flags=re.MULTILINE)
-    cleaned = re.sub(r"```$", "", cleaned, flags=re.MULTILINE)
+    # Remove assistant/user markers, EOF signals and fences
+    cleaned = clean_code_output(raw_output)
+
+    obj = _decode_first_object(cleaned)
+    if obj is None:
+        raise ValueError("No valid plan JSON object found in LLM output.")
+    return obj
+
+
+def _is_plan(obj):
+    return isinstance(obj, dict) and isinstance(obj.get("files"), list)
+
+
+def _decode_first_object(text):
+    # ✅ raw_decode stops at the end of the first object instead of matching up to the last '}'
+    start = text.find("{")
+    while start != -1:
+        resume = start + 1
+        try:
+            obj, end = _JSON_DECODER.raw_decode(text, start)
+            if _is_plan(obj):
+                return obj
+            resume = end  # a complete non-plan object: skip its nested braces too
+        except json.JSONDecodeError:
+            # ✅ Retry this candidate with cheap fix-ups for the usual small-model slips
+            # before moving on to braces inside it
+            try:
+                obj, _ = _JSON_DECODER.raw_decode(_heuristic_repair(text[start:]))
+                if _is_plan(obj):
+                    return obj
+            except json.JSONDecodeError:
+                pass
+        start = text.find("{", resume)
+    return None
 
-    # Extract the first JSON object
-    match = re.search(r"\{[\s\S]*\}", cleaned)
-    if not match:
-        raise ValueError("No valid JSON object found in LLM output.")
-    return match.group(0)
+
+_TRAILING_COMMA_RE = re.compile(r",(\s*[}\]])")
+_PY_LITERAL_RE = re.compile(r"([:\[,]\s*)(True|False|None)\b")
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+# Single-quoted keys/values with no quotes inside them
+_SINGLE_QUOTED_RE = re.compile(r"([{\[,:]\s*)'([^'\"\\\n]*)'(?=\s*[:,}\]])")
+
+
+# Double-quoted JSON strings; split() with this group puts them at the odd indices
+_JSON_STRING_RE = re.compile(r'("(?:[^"\\\n]|\\.)*")')
+
+
+def _heuristic_repair(text):
+    """
+    Fix trailing commas, Python True/False/None and simple single-quoted strings.
+    Only used on a candidate that strict decoding has already rejected.
+    Text inside double-quoted strings (file prompts, paths) is never rewritten.
+    """
+    parts = _JSON_STRING_RE.split(text)
+    for i in range(0, len(parts), 2):
+        part = _SINGLE_QUOTED_RE.sub(r'\1"\2"', parts[i])
+        part = _PY_LITERAL_RE.sub(lambda m: m.group(1) + _PY_LITERALS[m.group(2)], part)
+        parts[i] = _TRAILING_COMMA_RE.sub(r"\1", part)
+    return "".join(parts)
 
 
 def load_plan_from_raw(raw_output):
     """
     Extract JSON from raw LLM output and load it as a dictionary.
     """
-    json_str = extract_first_json(raw_output)
-    return json.loads(json_str)
+    return extract_first_json(raw_output)
 
 
 # ------------------------------
-# Generate Project Plan
+# Plan Cache
 # ------------------------------
-def generate_plan(job_id, prompt, projects_dir, llama_path, model_plan_path, update_job_status):
-    project_folder = os.path.join(projects_dir, f"job_{job_id}")
-    os.makedirs(project_folder, exist_ok=True)
+# Identical submissions reuse an earlier plan instead of re-running the architect model
+PLAN_CACHE_ENABLED = os.getenv("PLAN_CACHE", "1") == "1"
+PLAN_CACHE_DIRNAME = "plan_cache"
 
-    # ✅ Save original prompt for later phases
-    prompt_file = os.path.join(project_folder, "prompt.txt")
-    with open(prompt_file, "w") as f:
-        f.write(prompt)
 
-    # ✅ Architect Prompt
-    plan_prompt = f"""
-You are a senior software architect. Based on this description:
-{prompt}
+def plan_prompt_cache_path(cmd):
+    """
+    llama-cli --prompt-cache file for the plan prompt prefix. Keyed by the full argv
+    (model, context size, KV cache type, ...) and the template, so a config change
+    never loads an incompatible session.
+    """
+    digest = hashlib.sha256("\0".join(cmd + [PLAN_PROMPT_TEMPLATE]).encode("utf-8")).hexdigest()
+    return os.path.join(PLAN_PROMPT_CACHE_DIR, f"deepseek_plan_{digest[:16]}.kv")
+
+
+def plan_cache_key(prompt, model_plan_path):
+    """
+    Hash of the whitespace-normalized prompt, the plan model and the prompt template.
+    """
+    h = hashlib.sha256()
+    for part in (model_plan_path, PLAN_PROMPT_TEMPLATE, " ".join(prompt.split())):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
 
-Generate ONLY valid JSON in this format:
+def load_cached_plan(projects_dir, key):
+    """
+    Return the cached plan for key, or None if absent or unreadable.
+    """
+    path = os.path.join(projects_dir, PLAN_CACHE_DIRNAME, f"{key}.json")
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return plan if is_cacheable_plan(plan) else None
+
+
+def is_cacheable_plan(plan):
+    """Only a usable plan (non-empty files, each with a path) may be replayed for later jobs."""
+    files = plan.get("files") if isinstance(plan, dict) else None
+    return bool(files) and isinstance(files, list) and all(
+        isinstance(entry, dict) and isinstance(entry.get("path"), str) and entry["path"].strip()
+        for entry in files
+    )
+
+
+def store_cached_plan(projects_dir, key, plan):
+    """
+    Write plan to the cache atomically so readers never see a half-written entry.
+    Plans that fail is_cacheable_plan are skipped, so one bad run can't poison the prompt.
+    """
+    if not is_cacheable_plan(plan):
+        logging.warning(f"[Plan Cache] Not caching {key}: plan has no usable files")
+        return
+    cache_dir = os.path.join(projects_dir, PLAN_CACHE_DIRNAME)
+    path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(plan, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"[Plan Cache] Failed to store {key}: {e}")
+
+
+# ------------------------------
+# Generate Project Plan
+# ------------------------------
+# Built once at import; only the user's description is substituted per job.
+# The description goes LAST so every plan prompt starts with the same static text,
+# which llama.cpp can then reuse from its KV cache instead of prefilling it again.
+PLAN_PROMPT_TEMPLATE = """
+You are a senior software architect. Based on the project description at the end,
+generate ONLY valid JSON in this format:
 {{
   "project_name": "short descriptive name",
   "files": [
@@ -80,23 +196,45 @@ Rules:
 - Add SQL schema file if DB is required
 - Avoid placeholders: use real example content
 - Output ONLY JSON (no markdown, no commentary)
+
+Project description:
+{prompt}
 """
+# Saved KV state of the static prefix, shared by every plan run on the same model + template
+PLAN_PROMPT_CACHE_DIR = tempfile.gettempdir()
+
+def generate_plan(job_id, prompt, projects_dir, llama_path, model_plan_path, update_job_status):
+    project_folder = os.path.join(projects_dir, f"job_{job_id}")
+    os.makedirs(project_folder, exist_ok=True)
+
+    # ✅ Save original prompt for later phases
+    prompt_file = os.path.join(project_folder, "prompt.txt")
+    with open(prompt_file, "w") as f:
+        f.write(prompt)
+
+    # ✅ Architect Prompt
+    plan_prompt = PLAN_PROMPT_TEMPLATE.format(prompt=prompt)
 
-    cmd = [
-        llama_path, "-m", model_plan_path,
-        "-t", "28",
-        "--ctx-size", "8192",
-        "--n-predict", "4096",
-        "--temp", "0.2",
-        "--top-p", "0.9",
-        "--repeat-penalty", "1.1",
-        "-p", plan_prompt
-    ]
+    cache_key = plan_cache_key(prompt, model_plan_path) if PLAN_CACHE_ENABLED else None
+    if cache_key:
+        plan = load_cached_plan(projects_dir, cache_key)
+        if plan is not None:
+            logging.info(f"[Project Job {job_id}] Reusing cached plan {cache_key[:12]}")
+            return _save_plan(job_id, project_folder, plan, update_job_status, cached=True)
+
+    cmd = build_cmd(llama_path, model_plan_path, ctx_size=8192, n_predict=4096,
+                    temp=0.2, top_p=0.9, repeat_penalty=1.1)
 
     logging.info(f"[Project Job {job_id}] Generating structured plan.json...")
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
-        raw_output = result.stdout.strip()
+        # ✅ Stop llama.cpp once the plan object closes instead of letting it ramble to n_predict
+        guard = JsonObjectGuard(ignore=plan_prompt, inner=RunawayGuard(), accept=_is_plan)
+        watch = LineProgress(guard, lambda lines: update_job_status(
+            job_id, "processing", current_step=f"Generating plan ({lines} lines)"))
+        # ✅ First run saves the KV state; later runs load it read-only and only prefill the description
+        prompt_cache = plan_prompt_cache_path(cmd)
+        raw_output = run_llama(cmd, plan_prompt, timeout=1800, prompt_cache=prompt_cache,
+                               prompt_cache_ro=os.path.exists(prompt_cache), should_stop=watch).strip()
     except subprocess.TimeoutExpired:
         logging.error(f"[Project Job {job_id}] LLM process timed out.")
         update_job_status(job_id, "error", "Plan generation timed out.")
@@ -119,17 +257,27 @@ Rules:
         update_job_status(job_id, "error", "Plan generation failed: Invalid JSON.")
         return False
 
+    if cache_key:
+        store_cached_plan(projects_dir, cache_key, plan)
+
+    return _save_plan(job_id, project_folder, plan, update_job_status)
+
+
+def _save_plan(job_id, project_folder, plan, update_job_status, cached=False):
     # ✅ Save parsed plan.json
     plan_path = os.path.join(project_folder, "plan.json")
     try:
-        with open(plan_path, "w") as f:
+        # Write-then-rename so a crash never leaves a half-written plan.json behind
+        with open(plan_path + ".tmp", "w") as f:
             json.dump(plan, f, indent=2)
+        os.replace(plan_path + ".tmp", plan_path)
     except Exception as e:
         logging.error(f"[Project Job {job_id}] Failed to write plan.json: {e}")
         update_job_status(job_id, "error", "Failed to save plan.json.")
         return False
 
     # ✅ Update status
-    update_job_status(job_id, "planned", f"Plan saved with {len(plan.get('files', []))} files.")
+    source = " (cached)" if cached else ""
+    update_job_status(job_id, "planned", f"Plan saved with {len(plan.get('files', []))} files{source}.")
     logging.info(f"[Project Job {job_id}] Plan saved at {plan_path}")
     return True
@@ -1,8 +1,7 @@
-import subprocess
 import json
 import logging
 import os
-import re
+from llm import build_cmd, run_llama, clean_code_output, RunawayGuard
 
 MAX_REPAIR_ATTEMPTS = 5
 
@@ -33,13 +32,6 @@ LANGUAGE_HINTS = {
     "Java": "Ensure correct class structure, package declarations if needed, and standard Java syntax."
 }
 
-def clean_code_output(raw_output):
-    raw_output = re.sub(r'^.*assistant\s*', '', raw_output, flags=re.DOTALL)
-    raw_output = re.sub(r'>\s*EOF.*$', '', raw_output, flags=re.MULTILINE)
-    raw_output = re.sub(r"^```[a-zA-Z]*", "", raw_output.strip(), flags=re.MULTILINE)
-    raw_output = re.sub(r"```$", "", raw_output, flags=re.MULTILINE)
-    return raw_output.strip()
-
 def is_dependency_issue(issues):
     if "Placeholder text found" in issues:  # ✅ Always repair placeholders
         return False
@@ -51,6 +43,9 @@ def repair_project(job_id, project_folder, failed_files, original_prompt, plan,
                    update_job_status):
     total_failures = len(failed_files)
     logging.info(f"[Repair] Starting repair process for {total_failures} files.")
+    plan_json = json.dumps(plan, indent=2)
+    cmd = build_cmd(LLAMA_PATH, MODEL_CODE_PATH, ctx_size=8192, n_predict=4096,
+                    temp=0.25, top_p=0.9, repeat_penalty=1.05)
 
     for attempt in range(1, MAX_REPAIR_ATTEMPTS + 1):
         logging.info(f"[Repair] Attempt {attempt}/{MAX_REPAIR_ATTEMPTS}")
@@ -78,7 +73,7 @@ Project Description:
 {original_prompt}
 
 Plan:
-{json.dumps(plan, indent=2)}
+{plan_json}
 
 Task:
 {file_specific_prompt}
@@ -105,23 +100,16 @@ Rules:
             logging.info(f"[Repair] {current_step}")
 
             # Call LLM for repair
-            cmd = [
-                LLAMA_PATH, "-m", MODEL_CODE_PATH, "-t", "28",
-                "--ctx-size", "8192", "--n-predict", "4096",
-                "--temp", "0.25", "--top-p", "0.9", "--repeat-penalty", "1.05",
-                "-p", repair_prompt
-            ]
             try:
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=1200)
-                cleaned_output = clean_code_output(result.stdout.strip())
+                cleaned_output = clean_code_output(run_llama(cmd, repair_prompt, timeout=1200, should_stop=RunawayGuard()).strip())
 
                 # If the LLM returned empty or too short output, insert error placeholder
                 if not cleaned_output or len(cleaned_output.splitlines()) < 2:
                     cleaned_output = f"// ERROR: LLM returned insufficient repair content for {rel_path}\n"
 
                 os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                with open(file_path, "w") as f:
-                    f.write(cleaned_output)
+                with open(file_path, "wb") as f:
+                    f.write(cleaned_output.encode("utf-8"))
 
                 logging.info(f"[Repair] ✅ Updated {rel_path}")
             except Exception as e:
@@ -134,10 +122,8 @@ Rules:
         failed_files = analyze_validation_results(validation_results)
 
         if not failed_files:
-            logging.info("[Repair] ✅ All issues resolved!")
-            update_job_status(job_id, "completed", f"Repaired successfully. Report: {report_path}", 100, "Repair complete")
+            logging.info(f"[Repair] ✅ All issues resolved! Report: {report_path}")
             return True
 
-    logging.warning("[Repair] ⚠ Max repair attempts reached. Some files still have issues.")
-    update_job_status(job_id, "completed", f"Partial success. See VALIDATION_REPORT.txt", 100, "Repair incomplete")
+    logging.warning("[Repair] ⚠ Max repair attempts reached. Some files still have issues. See VALIDATION_REPORT.txt")
     return False
@@ -2,6 +2,8 @@ import os
 import subprocess
 import re
 import logging
+import sqlite3
+import traceback
 from datetime import datetime
 import shutil
 
@@ -53,11 +55,17 @@ def safe_read_text(file_path):
 # Validators
 # ----------------------------
 def validate_python(file_path):
+    # In-process compile: same syntax check as py_compile without forking an interpreter
+    # or leaving __pycache__ behind in the project ZIP
+    source = safe_read_text(file_path)
+    if source is None:
+        return "[SKIPPED] Binary or unreadable file"
     try:
-        subprocess.check_output(["python3", "-m", "py_compile", file_path], stderr=subprocess.STDOUT)
+        compile(source, file_path, "exec", dont_inherit=True)
         return "[OK]"
-    except subprocess.CalledProcessError as e:
-        return f"[ERROR] {e.output.decode('utf-8')}"
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+        # Deeply nested generated code overflows the compiler in-process; report it like a syntax error
+        return f"[ERROR] {''.join(traceback.format_exception_only(type(e), e))}"
 
 def validate_python_requirements(project_folder):
     req_path = os.path.join(project_folder, "requirements.txt")
@@ -139,11 +147,17 @@ def validate_cmake(file_path):
     return "[OK]" if not issues else f"[WARN] {'; '.join(issues)}"
 
 def validate_sql(file_path):
+    content = safe_read_text(file_path)
+    if content is None:
+        return "[SKIPPED] Binary or unreadable file"
+    conn = sqlite3.connect(":memory:")
     try:
-        result = subprocess.run(["sqlite3", ":memory:", f".read {file_path}"], capture_output=True, text=True)
-        return "[OK]" if result.returncode == 0 else f"[ERROR] {result.stderr.strip()}"
-    except Exception as e:
-        return f"[WARN] sqlite3 not installed or failed: {e}"
+        conn.executescript(content)
+        return "[OK]"
+    except sqlite3.Error as e:
+        return f"[ERROR] {e}"
+    finally:
+        conn.close()
 
 def validate_requirements(file_path):
     invalid_lines = []
@@ -165,11 +179,73 @@ def scan_placeholders(file_path):
 # ----------------------------
 # Main Validation Logic
 # ----------------------------
-def validate_project(project_folder):
+def file_stamp(file_path):
+    """Cheap change detector for a file: (mtime_ns, size)."""
+    st = os.stat(file_path)
+    return (st.st_mtime_ns, st.st_size)
+
+def is_standalone_file(file_path):
+    """
+    True for files whose validation result depends only on their own content.
+    C++/Go/Java results depend on sibling files, so they are not validated early.
+    """
+    file = os.path.basename(file_path)
+    return (file.endswith((".py", ".html", ".sql")) or file == "requirements.txt"
+            or file.lower() in ("dockerfile", "cmakelists.txt"))
+
+def validate_file(file_path, project_folder):
+    """
+    Validate a single file.
+    Returns (result, language, missing_deps) so it can run ahead of validate_project.
+    """
+    file = os.path.basename(file_path)
+    missing_deps = set()
+    language = None
+    if is_binary_file(file_path):
+        return "[SKIPPED] Binary file", language, missing_deps
+
+    if file.endswith(".py"):
+        language = "Python"
+        result = validate_python(file_path)
+    elif file.endswith(".cpp") or file.endswith(".h"):
+        language = "C++"
+        result = validate_cpp(file_path, missing_deps)
+    elif file.endswith(".go"):
+        language = "Go"
+        result = validate_go(file_path, project_folder)
+    elif file.endswith(".java"):
+        language = "Java"
+        result = validate_java(file_path, project_folder)
+    elif file.endswith(".html"):
+        result = validate_html(file_path)
+    elif file.lower() == "dockerfile":
+        result = validate_docker(file_path)
+    elif file.lower() == "cmakelists.txt":
+        result = validate_cmake(file_path)
+    elif file.endswith(".sql"):
+        result = validate_sql(file_path)
+    elif file == "requirements.txt":
+        result = validate_requirements(file_path)
+    else:
+        result = "[SKIPPED] Non-code file"
+
+    placeholder = scan_placeholders(file_path)
+    if placeholder:
+        result += f" | {placeholder}"
+    return result, language, missing_deps
+
+def validate_project(project_folder, prevalidated=None):
+    """
+    Validate every file in the project.
+    prevalidated maps normalized file paths to (file_stamp, validate_file result);
+    entries whose stamp still matches the file on disk are reused as-is.
+    """
     logging.info(f"[Validation] Starting validation in {project_folder}")
     results = {}
     missing_deps = set()
     detected_languages = set()
+    prevalidated = prevalidated or {}
+    reused = 0
 
     for root, dirs, files in os.walk(project_folder):
         dirs[:] = [d for d in dirs if d not in IGNORE_DIRS]
@@ -177,38 +253,20 @@ def validate_project(project_folder):
             if file in IGNORE_FILES or any(file.endswith(ext) for ext in IGNORE_EXTENSIONS):
                 continue
             file_path = os.path.join(root, file)
-            if is_binary_file(file_path):
-                results[file_path] = "[SKIPPED] Binary file"
-                continue
-
-            if file.endswith(".py"):
-                detected_languages.add("Python")
-                results[file_path] = validate_python(file_path)
-            elif file.endswith(".cpp") or file.endswith(".h"):
-                detected_languages.add("C++")
-                results[file_path] = validate_cpp(file_path, missing_deps)
-            elif file.endswith(".go"):
-                detected_languages.add("Go")
-                results[file_path] = validate_go(file_path, project_folder)
-            elif file.endswith(".java"):
-                detected_languages.add("Java")
-                results[file_path] = validate_java(file_path, project_folder)
-            elif file.endswith(".html"):
-                results[file_path] = validate_html(file_path)
-            elif file.lower() == "dockerfile":
-                results[file_path] = validate_docker(file_path)
-            elif file.lower() == "cmakelists.txt":
-                results[file_path] = validate_cmake(file_path)
-            elif file.endswith(".sql"):
-                results[file_path] = validate_sql(file_path)
-            elif file == "requirements.txt":
-                results[file_path] = validate_requirements(file_path)
+            cached = prevalidated.get(os.path.normpath(file_path))
+            if cached and cached[0] == file_stamp(file_path):
+                result, language, file_deps = cached[1]
+                reused += 1
             else:
-                results[file_path] = "[SKIPPED] Non-code file"
+                result, language, file_deps = validate_file(file_path, project_folder)
+
+            results[file_path] = result
+            if language:
+                detected_languages.add(language)
+            missing_deps.update(file_deps)
 
-            placeholder = scan_placeholders(file_path)
-            if placeholder:
-                results[file_path] += f" | {placeholder}"
+    if reused:
+        logging.info(f"[Validation] Reused {reused} results validated during generation.")
 
     py_dep_check = validate_python_requirements(project_folder)
     if py_dep_check:
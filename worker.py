@@ -0,0 +1,142 @@
+import functools
+import logging
+import os
+import sqlite3
+import time
+import zipfile
+from db import (init_db, update_job_status, claim_next_job, wait_for_job, ProgressThrottle, reset_connection,
+                requeue_interrupted_jobs)
+import llm
+import planning
+import coding
+import quickmode  # ✅ Quick mode handler
+
+# ----------------- Config -----------------
+# ✅ Centralized constants
+PROJECTS_DIR = "/home/smithkt/deepseek_projects"
+LLAMA_PATH = "/home/smithkt/llama.cpp/build/bin/llama-cli"
+MODEL_PLAN_PATH = os.environ.get("MODEL_PLAN_PATH", "/home/smithkt/models/qwen/qwen2.5-coder-14b-instruct-q4_0.gguf")
+# Same q4_0 file as the planner by default, so only one 14B model is ever mapped;
+# MODEL_CODE_PATH can point at an iq4_xs quant (~4.25 bpw) for fewer bytes per decoded token
+MODEL_CODE_PATH = os.environ.get("MODEL_CODE_PATH", "/home/smithkt/models/qwen/qwen2.5-coder-14b-instruct-q4_0.gguf")
+# ✅ Optional smaller planner (e.g. a 3B instruct q4_k_m) used for short descriptions; empty = always MODEL_PLAN_PATH
+MODEL_PLAN_SMALL_PATH = os.environ.get("MODEL_PLAN_SMALL_PATH", "")
+PLAN_SMALL_MAX_PROMPT = int(os.environ.get("PLAN_SMALL_MAX_PROMPT", "2000"))  # characters
+# ✅ Per-file generation/repair model; point at a smaller quant (iq4_xs, q3_k_s, iq3_xs) to trade quality for tokens/sec
+MODEL_FILE_PATH = os.environ.get("MODEL_FILE_PATH", MODEL_CODE_PATH)
+
+# ✅ Set to 0 when running several worker processes, so one starting up doesn't requeue another's jobs
+REQUEUE_ON_START = os.environ.get("REQUEUE_ON_START", "1") == "1"
+
+os.makedirs(PROJECTS_DIR, exist_ok=True)
+
+# ✅ Job handlers with the fixed paths/models bound once; the loop only passes per-job values
+generate_plan = functools.partial(
+    planning.generate_plan, projects_dir=PROJECTS_DIR, llama_path=LLAMA_PATH,
+    model_plan_path=MODEL_PLAN_PATH, update_job_status=update_job_status
+)
+generate_files = functools.partial(
+    coding.generate_files, PROJECTS_DIR=PROJECTS_DIR, LLAMA_PATH=LLAMA_PATH, MODEL_CODE_PATH=MODEL_FILE_PATH
+)
+generate_quick_code = functools.partial(
+    quickmode.generate_quick_code, LLAMA_PATH=LLAMA_PATH, MODEL_CODE_PATH=MODEL_CODE_PATH,
+    update_job_status=update_job_status
+)
+
+# ----------------- Helpers -----------------
+def plan_model_for(prompt):
+    """The plan JSON schema is fixed, so short descriptions don't need the full-size model."""
+    if MODEL_PLAN_SMALL_PATH and len(prompt) < PLAN_SMALL_MAX_PROMPT:
+        return MODEL_PLAN_SMALL_PATH
+    return MODEL_PLAN_PATH
+
+def zip_project(project_folder, zip_path):
+    """
+    Zips project_folder into zip_path (fast deflate level 1), skipping the
+    archive itself, then swaps it into place so downloads never see a partial file.
+    """
+    tmp_path = zip_path + ".tmp"
+    skip = {os.path.basename(zip_path), os.path.basename(tmp_path)}
+    prefix_len = len(project_folder.rstrip(os.sep)) + 1
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as z:
+        for root, dirs, files in os.walk(project_folder):
+            dirs[:] = [d for d in dirs if d != "__pycache__"]
+            for file in files:
+                if root == project_folder and file in skip:
+                    continue
+                abs_path = os.path.join(root, file)
+                z.write(abs_path, abs_path[prefix_len:])
+    os.replace(tmp_path, zip_path)
+
+# ----------------- Worker -----------------
+def worker():
+    logging.info("Worker thread started")
+    # ✅ A job survives a worker crash/restart: whatever was mid-run is picked up again
+    if REQUEUE_ON_START:
+        requeued, failed = requeue_interrupted_jobs()
+        if requeued:
+            logging.info(f"[Worker] Requeued {requeued} interrupted job(s)")
+        if failed:
+            logging.warning(f"[Worker] Failed {failed} job(s) that were interrupted too many times")
+    # ✅ Load the code model once; per-file generations then skip the llama-cli cold start
+    llm.start_server(LLAMA_PATH, MODEL_FILE_PATH)
+    while True:
+        try:
+            job = claim_next_job()
+
+            if job:
+                job_id, prompt, job_type = job
+                logging.info(f"[Worker] Processing job {job_id} ({job_type})")
+
+                if job_type == "project":
+                    try:
+                        # claim_next_job already set status='processing'; no second write needed here
+                        success = generate_plan(job_id, prompt, model_plan_path=plan_model_for(prompt))
+
+                        if success:
+                            update_job_status(job_id, "processing", "Generating and validating code...")
+                            # ✅ Coalesce per-file progress writes; errors/terminal states pass straight through
+                            progress_update = ProgressThrottle(update_job_status)
+                            try:
+                                report_path = generate_files(job_id, update_job_status=progress_update)
+                                progress_update.flush()
+                            finally:
+                                # A raise must not leave a timer that rewrites 'processing' over the error below
+                                progress_update.cancel()
+
+                            if report_path:
+                                # ✅ Create ZIP of the project
+                                project_folder = os.path.join(PROJECTS_DIR, f"job_{job_id}")
+                                zip_path = os.path.join(project_folder, f"job_{job_id}.zip")
+                                zip_project(project_folder, zip_path)
+                                update_job_status(job_id, "completed", f"Project complete. Validation: {report_path}")
+                                logging.info(f"[Worker] Job {job_id} zipped at {zip_path}")
+                        else:
+                            update_job_status(job_id, "error", "Plan generation failed.")
+                    except Exception as e:
+                        logging.error(f"[Worker] Error in project workflow: {e}")
+                        update_job_status(job_id, "error", f"Workflow error: {e}")
+
+                elif job_type == "chat":
+                    try:
+                        generate_quick_code(job_id, prompt)
+                    except Exception as e:
+                        logging.error(f"[Worker] Error in quickmode: {e}")
+                        update_job_status(job_id, "error", f"QuickMode error: {e}")
+
+            else:
+                wait_for_job(timeout=30)
+        except sqlite3.OperationalError as e:
+            # e.g. disk I/O error or a replaced DB file: reopen rather than retry a broken handle forever
+            logging.error(f"Worker DB error, reconnecting: {e}")
+            reset_connection()
+            time.sleep(5)
+        except Exception as e:
+            logging.error(f"Worker loop error: {e}")
+            time.sleep(5)
+
+# Standalone service: python worker.py (run the web app with EMBEDDED_WORKER=0)
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    init_db()
+    worker()